@@ -6,6 +6,7 @@ BASEDIR=$(dirname "$0")
 DOCKER_IMAGE=${DOCKER_IMAGE:-ghcr.io/datadog/dd-dependency-sniffer:latest}
 M2_HOME=${M2_HOME:-"$HOME"/.m2}
 GRADLE_USER_HOME=${GRADLE_USER_HOME:-"$HOME"/.gradle}
+SNIFFER_CACHE=${XDG_CACHE_HOME:-"$HOME"/.cache}/dd-dependency-sniffer
 
 test_command() {
   if ! command -v "$1" >/dev/null 2>&1
@@ -94,6 +95,10 @@ else
   cmd="$cmd -v $GRADLE_USER_HOME:/home/datadog/.gradle"
 fi
 
+# mount the cache so the results can be reused between runs
+mkdir -p "$SNIFFER_CACHE"
+cmd="$cmd -v $SNIFFER_CACHE:/home/datadog/.cache/dd-dependency-sniffer"
+
 # mount log file
 log=$(mktemp -t "dd-dependency-sniffer.XXX.log")
 cmd="$cmd -v $log:/home/datadog/dd-dependency-sniffer.log"
@@ -1,31 +1,67 @@
 #!/usr/bin/env python3
 
 import argparse
+import base64
+import fcntl
+import hashlib
+import http.client
+import io
 import itertools
 import json
 import logging
+import mmap
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import zipfile
+import zlib
 from argparse import Namespace
-from dataclasses import dataclass
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
-from functools import reduce
-from pathlib import Path
-from urllib.error import URLError
 
 WORKSPACE = os.environ.get("WORKSPACE", os.path.join(os.environ.get("HOME"), "workspace"))
 LOG_FILE = os.environ.get("LOG_FILE", os.path.join(os.environ.get("HOME"), "dd-dependency-sniffer.log"))
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.environ.get("HOME"), ".cache")), "dd-dependency-sniffer"
+)
+INDEX_FILE = os.path.join(CACHE_DIR, "index.json")
+RESOLVE_INDEX_FILE = os.path.join(CACHE_DIR, "resolve-index.json")
+ZIP_MAGIC = b"PK\x03\x04"
 MAX_FILES_PER_DEPENDENCY = 3
+MAX_DOWNLOAD_WORKERS = 16
+MAX_DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.3  # seconds, doubled after each retry
+MAVEN_CENTRAL_HOST = "repo1.maven.org"
 
-logging.basicConfig(filename=LOG_FILE,
-                    filemode='w',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.DEBUG)
+# e.g. '+--- org.slf4j:slf4j-api:2.0.10 -> 2.0.16 (*)', the upgraded version, a classifier after the version and the
+# trailing (*), (c)... are handled
+_GRADLE_DEPENDENCY = re.compile(
+    rb"[+\\]--- (?P<group>[^:\s]+):(?P<artifact>[^:\s]+):(?:.+ -> )?(?P<version>[^:\s]+?)(?::\S+)?(?: \(.+\))?\s*?$",
+    re.MULTILINE,
+)
+
+# sidecars might hold anything, e.g. an error page cached by a proxy, so only actual hashes are trusted
+_SHA1 = re.compile(r"[0-9a-fA-F]{40}")
+
+# raised while reading a corrupt (zlib.error, EOFError) or unsupported (NotImplementedError) archive entry, encrypted
+# entries are never read as zipfile would need their password
+_ZIP_READ_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError)
+
+
+_connections = threading.local()
+_staged_artifacts = dict()  # sha1 -> file in the workspace
+_searches = dict()  # (search key, workspace fingerprint) -> matching files
+_resolved_artifacts = dict()  # coordinates -> [artifact in the local repositories, sha1, size, mtime]
 
 
 class Type(Enum):
@@ -36,38 +72,35 @@ class Type(Enum):
         return self.value
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Dependency:
     group_id: str
     artifact_id: str
     version: str
-    scope: str
-    type: str
-
-    def __init__(
-        self,
-        group_id: str,
-        artifact_id: str,
-        version: str,
-        scope: str = None,
-        type: str = "jar",
-    ):
-        self.group_id = group_id
-        self.artifact_id = artifact_id
-        self.version = version
-        self.scope = scope
-        self.type = type
-
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (
-                self.group_id == other.group_id
-                and self.artifact_id == other.artifact_id
-                and self.version == other.version
-            )
+    scope: str = field(default=None, compare=False)
+    type: str = field(default="jar", compare=False)
+    group_path: str = field(init=False, repr=False, compare=False)
+    _hash: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # path of the group in maven repositories, e.g. org/slf4j
+        object.__setattr__(self, "group_path", self.group_id.replace(".", "/"))
+        # dependencies live in sets, so the hash is only computed once
+        object.__setattr__(self, "_hash", hash((self.group_id, self.artifact_id, self.version)))
 
     def __hash__(self):
-        return hash((self.group_id, self.artifact_id, self.version))
+        return self._hash
+
+    @property
+    def file_name(self) -> str:
+        """Name of the artifact in maven repositories, e.g. slf4j-api-2.0.16.jar"""
+        return f"{self.artifact_id}-{self.version}.{self.type}"
+
+    @property
+    def workspace_name(self) -> str:
+        """Name of the artifact in the workspace, prefixed with the group as artifact ids are not unique across groups,
+        e.g. org.slf4j.slf4j-api-2.0.16.jar"""
+        return f"{self.group_id}.{self.file_name}"
 
     def __str__(self):
         return f"{self.group_id}:{self.artifact_id}:{self.version}"
@@ -89,18 +122,20 @@ def _analyze_java_dependencies(args: Namespace):
         print(f"{message} has not been found in any dependencies")
         return
 
-    dependencies = dict()
+    prefix = WORKSPACE + os.sep
+    dependencies = defaultdict(list)
     for item in result:
-        start = item.find("{")
-        if start >= 0:
-            end = item.rfind("}")
-            parent_file = item[len(WORKSPACE) + 1: start]
-            children_ref = item[start + 1: end]
+        parent_file, brace, children_ref = item.partition("{")
+        if brace:
+            parent_file = parent_file.removeprefix(prefix)
+        children = dependencies[parent_file]
+        if len(children) > MAX_FILES_PER_DEPENDENCY:
+            continue  # only the first files are reported, the rest is collapsed into [...]
+        if brace:
+            children_ref = children_ref.rpartition("}")[0]
         else:
             # should not happen as we are dealing with nested jars
-            parent_file = item
             children_ref = item
-        children = dependencies.setdefault(parent_file, [])
         children.append(children_ref)
 
     print(f"{message} has been found in {len(dependencies)} dependencies:\n")
@@ -114,151 +149,516 @@ def _analyze_java_dependencies(args: Namespace):
         print()
 
 def _find_java_packages(args: Namespace) -> list[str]:
-    """Finds java binaries with the selected package name in the bytecode and makes sure it's the original class and
-    not a reference"""
+    """Finds java binaries stored under the selected package name in the dependencies, so only the original classes
+    are reported and not the ones referencing them"""
     vm_package = args.package.replace(".", "/")
-    result = subprocess.run(
-        [
-            "ug",
-            "-r",  # recurse
-            "-z",
-            f"--zmax={args.depth}",  # decompress files
-            "-o",  # only output the match
-            "-e",
-            f"{vm_package}",  # containing the package declaration
-            "--json",
-            WORKSPACE,
-        ],
-        capture_output=True,
-    )
-
-    if len(result.stderr) > 0:
-        error = result.stderr.decode()
-        raise RuntimeError(error)
-
-    matches = json.loads(result.stdout)
-    vm_package_regexp = r"\b" + re.escape(vm_package)
-    return [match["file"] for match in matches if re.search(vm_package_regexp, match["file"])]
+    # a single pass over the whole listing of each dependency, one line per file
+    vm_package_regexp = re.compile(r"^.*\b" + re.escape(vm_package) + r".*$", re.MULTILINE)
+    return [
+        f"{path}{entry}"
+        for path, entries in _workspace_index(args).items()
+        for entry in vm_package_regexp.findall(entries)
+    ]
+
+
+def _workspace_index(args: Namespace) -> dict[str, str]:
+    """Lists the files stored in each dependency of the workspace, the listings are kept on disk and the dependency is
+    only opened again if its size or modification time changed"""
+    index = _load_cache_file(INDEX_FILE, None)
+    if not isinstance(index, dict):
+        index = dict()
+
+    stale = []
+    workspace_index = dict()
+    with os.scandir(WORKSPACE) as files:
+        for file in files:
+            stat = file.stat()
+            signature = [stat.st_size, stat.st_mtime_ns, args.depth]
+            listing = index.get(file.name)
+            if (
+                not isinstance(listing, dict)
+                or listing.get("signature") != signature
+                or not isinstance(listing.get("entries"), str)
+            ):
+                stale.append((file, signature))
+            else:
+                workspace_index[file.name] = listing
+
+    if len(stale) > 0:
+        # listing nested archives is CPU bound, the biggest ones are submitted first to balance the workers
+        stale.sort(key=lambda item: item[1][0], reverse=True)
+        with ProcessPoolExecutor() as executor:
+            paths = [file.path for file, _ in stale]
+            listings = executor.map(_archive_entries, paths, itertools.repeat(args.depth))
+            for (file, signature), entries in zip(stale, listings):
+                workspace_index[file.name] = {"signature": signature, "entries": entries}
+
+    if len(stale) > 0 or len(workspace_index) != len(index):
+        _store_cache_file(INDEX_FILE, workspace_index)
+
+    return {os.path.join(WORKSPACE, name): workspace_index[name]["entries"] for name in sorted(workspace_index)}
+
+
+def _archive_entries(path: str, depth: int) -> str:
+    """Lists the files in the archive following ug's notation for nested archives, e.g. '{lib/b.jar}{org/C.class}',
+    one file per line"""
+    if not zipfile.is_zipfile(path):
+        return ""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return "\n".join(_zip_entries(archive, path, "", 1, depth))
+    except (OSError, *_ZIP_READ_ERRORS):
+        logging.exception(f"Failed to list the files in '{path}'")
+        return ""
+
+
+def _zip_entries(archive: zipfile.ZipFile, path: str, prefix: str, level: int, depth: int) -> list[str]:
+    entries = []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        entry = f"{prefix}{{{info.filename}}}"
+        # nested archives are detected by content like ug does (jar, war, hpi, nar...), classes are never archives so
+        # they are not opened
+        if level < depth and not info.filename.endswith(".class") and _is_nested_zip(archive, info):
+            try:
+                with zipfile.ZipFile(io.BytesIO(archive.read(info))) as nested:
+                    entries.extend(_zip_entries(nested, path, entry, level + 1, depth))
+                continue
+            except _ZIP_READ_ERRORS as e:
+                # the nested archive is listed as a plain file, the rest of the dependency is still indexed
+                logging.warning(f"Failed to list the files in '{path}{entry}': {e}")
+        entries.append(entry)
+    return entries
+
+
+def _is_nested_zip(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> bool:
+    if info.file_size < len(ZIP_MAGIC) or info.flag_bits & 0x1:  # too small or encrypted, it's listed as a plain file
+        return False
+    try:
+        with archive.open(info) as entry:
+            return entry.read(len(ZIP_MAGIC)) == ZIP_MAGIC
+    except _ZIP_READ_ERRORS:
+        return False
 
 
 def _find_java_artifact(args: Namespace) -> list[str]:
     """Finds internal files like pom.xml, MANIFEST.MF containing the selected artifact"""
-    result = subprocess.run(
+    return _ug_search(
+        args,
         [
-            "ug",
-            "-r",  # recurse
-            "-z",
-            f"--zmax={args.depth}",  # decompress files
-            "-o",  # only output the match
             "-%",
             f"artifactId={args.artifact} OR Implementation-Title:.+{args.artifact} OR Bundle-.*Name:.+{args.artifact}",
-            # containing the artifact description
-            "--json",
-            WORKSPACE,
-        ],
-        capture_output=True,
+        ],  # containing the artifact description
     )
 
-    if len(result.stderr) > 0:
-        error = result.stderr.decode()
-        raise RuntimeError(error)
 
-    matches = json.loads(result.stdout)
-    return [match["file"] for match in matches]
+def _ug_search(args: Namespace, query: list[str]) -> list[str]:
+    """Decompresses the files in the workspace and returns the ones matching the query, results are cached on disk by
+    the contents of the workspace so repeated runs over the same dependencies don't decompress them again"""
+    key = _search_key(args, query)
+    fingerprint = _workspace_fingerprint()
+    if (key, fingerprint) in _searches:
+        return _searches[(key, fingerprint)]
+    # a single entry is kept per query, it's overwritten when the workspace changes
+    cache_file = os.path.join(CACHE_DIR, "search", f"{key}.json")
+    cached = _load_cache_file(cache_file, None)
+    if isinstance(cached, dict) and cached.get("workspace") == fingerprint:
+        return _searches.setdefault((key, fingerprint), cached["files"])
+
+    # decompression is CPU bound, so the workspace is split between several ug processes
+    shards = _workspace_shards()
+    jobs = max(1, (os.cpu_count() or 1) // max(1, len(shards)))
+    with ThreadPoolExecutor(max_workers=max(1, len(shards))) as executor:
+        results = executor.map(lambda shard: _ug_run(args, query, shard, jobs), shards)
+        files = [file for result in results for file in result]
+
+    _store_cache_file(cache_file, {"workspace": fingerprint, "files": files})
+    return _searches.setdefault((key, fingerprint), files)
+
+
+def _load_cache_file(cache_file: str, default):
+    try:
+        with open(cache_file) as cached:
+            return json.load(cached)
+    except (OSError, ValueError):
+        return default
+
+
+def _store_cache_file(cache_file: str, value):
+    """Writes the value in the cache, failures are only logged as the cache is not required for the analysis"""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(f"{cache_file}.tmp", "w") as cached:
+            json.dump(value, cached)
+        os.replace(f"{cache_file}.tmp", cache_file)
+    except OSError:
+        logging.exception(f"Failed to write the cache file '{cache_file}'")
+
+
+def _ug_run(args: Namespace, query: list[str], files: list[str], jobs: int) -> list[str]:
+    with tempfile.TemporaryFile() as errors:
+        with subprocess.Popen(
+            [
+                "ug",
+                "-r",  # recurse
+                "-z",
+                f"--zmax={args.depth}",  # decompress files
+                f"--jobs={jobs}",  # threads of this process
+                "-l",  # only output the matching files, one per line
+                *query,
+                *files,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=errors,
+            text=True,
+            bufsize=1 << 20,  # fewer reads from the pipe on large outputs
+        ) as process:
+            matches = [line.rstrip("\n") for line in process.stdout]
+
+        errors.seek(0)
+        error = errors.read()
+        if len(error) > 0:
+            raise RuntimeError(error.decode())
+
+    return matches
+
+
+def _workspace_shards() -> list[list[str]]:
+    """Splits the files in the workspace in groups of similar size, one per ug process"""
+    with os.scandir(WORKSPACE) as entries:
+        files = sorted(((entry.stat().st_size, entry.path) for entry in entries), reverse=True)
+    shards = [[] for _ in range(min(max(1, (os.cpu_count() or 1) // 2), len(files)))]
+    sizes = [0] * len(shards)
+    for size, path in files:
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(path)
+        sizes[smallest] += size
+    return shards
+
+
+def _search_key(args: Namespace, query: list[str]) -> str:
+    """Identifies a search by its query and the options it runs with"""
+    return hashlib.sha256(json.dumps([WORKSPACE, args.depth, query]).encode()).hexdigest()
+
+
+def _workspace_fingerprint() -> str:
+    """Fingerprints the files in the workspace by name, size and modification time, the times are preserved when
+    dependencies are staged so they only change when the artifact itself does"""
+    digest = hashlib.sha256()
+    with os.scandir(WORKSPACE) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            stat = entry.stat()
+            digest.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
 
 
 def _copy_java_dependencies(args: Namespace, dependencies: set[Dependency]):
     """Copies the selected dependencies into the workspace for further analysis"""
-    if not os.path.exists(WORKSPACE):
-        os.makedirs(WORKSPACE)
-    else:
-        for root, dirs, files in os.walk(WORKSPACE):
-            for f in files:
-                os.unlink(os.path.join(root, f))
-            for d in dirs:
-                shutil.rmtree(os.path.join(root, d))
+    os.makedirs(WORKSPACE, exist_ok=True)
+    # only the top level entries are visited, the workspace itself is kept as it might be a mount point, unlink
+    # releases the GIL so the entries are removed in parallel
+    with os.scandir(WORKSPACE) as entries, ThreadPoolExecutor() as executor:
+        list(executor.map(_remove_entry, entries))
 
+    _staged_artifacts.clear()
     home = os.environ.get("HOME")
     maven_home = os.path.join(home, ".m2", "repository")
     gradle_home = os.path.join(home, ".gradle", "caches", "modules-2", "files-2.1")
-
-    for dep in dependencies:
+    # the local repositories are checked once for all the dependencies, missing ones are skipped
+    if not os.path.isdir(maven_home):
+        maven_home = None
+    if not os.path.isdir(gradle_home):
+        gradle_home = None
+
+    # the index only holds if the same local repositories are used, otherwise every artifact is looked up again
+    roots = [maven_home, gradle_home]
+    resolve_index = _load_cache_file(RESOLVE_INDEX_FILE, dict())
+    if isinstance(resolve_index, dict) and resolve_index.get("roots") == roots:
+        _resolved_artifacts.update(resolve_index["artifacts"])
+    resolved_artifacts = dict(_resolved_artifacts)
+
+    def copy(dep: Dependency):
         try:
             if not _copy_java_dependency(dep, maven_home, gradle_home, WORKSPACE):
                 logging.error(f"Cannot find dependency with coordinates '{dep}'")
         except Exception:
             logging.exception(f"Failed to download dependency with coordinates '{dep}'")
 
+    # most of the time is spent waiting on the network, so fetch the dependencies concurrently, a single worker owns
+    # each workspace file and the files are renamed into place so concurrent copies never interleave
+    unique_dependencies = {dep.workspace_name: dep for dep in dependencies}
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        executor.map(copy, unique_dependencies.values())
+
+    if _resolved_artifacts != resolved_artifacts:
+        _store_cache_file(RESOLVE_INDEX_FILE, {"roots": roots, "artifacts": _resolved_artifacts})
+
+
+def _remove_entry(entry: os.DirEntry):
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path)
+    else:
+        os.unlink(entry.path)
+
 
 def _copy_java_dependency(
-    dep: Dependency, maven_home: str, gradle_home: str, target: str
+    dep: Dependency, maven_home: str | None, gradle_home: str | None, target: str
 ) -> bool:
     """Copies the selected dependency into the workspace, it first tries maven, then gradle and finally tries to
     resolve the dependency against maven central"""
-    if os.path.exists(maven_home) and _copy_maven_dependency(dep, maven_home, target):
+    # artifacts found in previous runs are copied right away, skipping the lookups in the local repositories, unless
+    # the file has been removed or rewritten since
+    key = f"{dep}:{dep.type}"
+    if key in _resolved_artifacts:
+        artifact_path, sha1, size, mtime_ns = _resolved_artifacts[key]
+        try:
+            stat = os.stat(artifact_path)
+            if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                _stage_artifact(artifact_path, os.path.join(target, dep.workspace_name), sha1)
+                return True
+        except FileNotFoundError:
+            pass
+        del _resolved_artifacts[key]
+
+    if maven_home is not None and _copy_maven_dependency(dep, maven_home, target):
         return True
 
-    if os.path.exists(gradle_home) and _copy_gradle_dependency(dep, gradle_home, target):
+    if gradle_home is not None and _copy_gradle_dependency(dep, gradle_home, target):
         return True
 
     return _copy_maven_central_dependency(dep, target)
 
 
 def _copy_maven_dependency(dep: Dependency, maven_home: str, target: str) -> bool:
-    group_path = reduce(
-        lambda result, item: os.path.join(result, item),
-        dep.group_id.split("."),
-        maven_home,
-    )
-    version_path = os.path.join(group_path, dep.artifact_id, dep.version)
-    file_name = f"{dep.artifact_id}-{dep.version}.{dep.type}"
-    artifact_path = os.path.join(version_path, file_name)
-    if os.path.exists(artifact_path):
-        shutil.copyfile(
-            artifact_path,
-            os.path.join(target, file_name),
-            follow_symlinks=True,
-        )
-        return True
+    version_path = os.path.join(maven_home, dep.group_path, dep.artifact_id, dep.version)
+    artifact_path = os.path.join(version_path, dep.file_name)
+    try:
+        stat = os.stat(artifact_path)
+    except FileNotFoundError:
+        return False
+    try:
+        with open(f"{artifact_path}.sha1") as checksum:
+            sha1 = checksum.read().split(maxsplit=1)[0]
+            # a checksum older than the artifact belongs to a previous install of it
+            if os.fstat(checksum.fileno()).st_mtime_ns < stat.st_mtime_ns:
+                sha1 = None
+    except (OSError, IndexError):
+        sha1 = None
+    try:
+        _stage_artifact(artifact_path, os.path.join(target, dep.workspace_name), sha1)
+    except FileNotFoundError:
+        return False
+    _resolve_artifact(dep, artifact_path, sha1, stat)
+    return True
 
 
 def _copy_gradle_dependency(dep: Dependency, gradle_home: str, target: str) -> bool:
     version_path = os.path.join(gradle_home, dep.group_id, dep.artifact_id, dep.version)
-    if not os.path.exists(version_path):
-        return False
-    file_name = f"{dep.artifact_id}-{dep.version}.{dep.type}"
-    path = Path(version_path)
     artifact_path = None
-    for f in path.iterdir():
-        final_path = os.path.join(f, file_name)
-        if f.is_dir() and os.path.isfile(final_path):
-            artifact_path = final_path
-            break
+    try:
+        # artifacts are stored in folders named after their hash
+        with os.scandir(version_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    final_path = os.path.join(entry.path, dep.file_name)
+                    if os.path.isfile(final_path):
+                        artifact_path = final_path
+                        break
+    except FileNotFoundError:
+        return False
 
     if artifact_path is not None:
-        shutil.copyfile(
-            artifact_path,
-            os.path.join(target, file_name),
-            follow_symlinks=True,
-        )
+        sha1 = os.path.basename(os.path.dirname(artifact_path)).zfill(40)  # gradle drops the leading zeros of the hash
+        _stage_artifact(artifact_path, os.path.join(target, dep.workspace_name), sha1)
+        _resolve_artifact(dep, artifact_path, sha1, os.stat(artifact_path))
         return True
 
 
+def _resolve_artifact(dep: Dependency, artifact_path: str, sha1: str | None, stat: os.stat_result):
+    """Remembers where the artifact was found for the next runs, along with its size and modification time so a
+    rewritten file is looked up again. Snapshots are left out as Gradle keeps the previous builds in other hash
+    folders, which would keep being served"""
+    if dep.version.endswith("-SNAPSHOT"):
+        return
+    if sha1 is not None and _SHA1.fullmatch(sha1) is None:
+        sha1 = None
+    _resolved_artifacts[f"{dep}:{dep.type}"] = [artifact_path, sha1, stat.st_size, stat.st_mtime_ns]
+
+
+def _stage_artifact(source: str, target: str, sha1: str | None):
+    """Copies the artifact into the workspace, if the same content has already been staged under a different name
+    the existing file is used as the source so it gets hard linked"""
+    if sha1 is not None and _SHA1.fullmatch(sha1) is None:
+        sha1 = None
+    if sha1 is not None:
+        sha1 = sha1.lower()
+        source = _staged_artifacts.get(sha1, source)
+    _fast_copy(source, target)
+    if sha1 is not None:
+        _staged_artifacts.setdefault(sha1, target)
+
+
+def _fast_copy(source: str, target: str):
+    """Hard links the file when both paths share a filesystem, the workspace is only read so sharing the inode is safe.
+    Otherwise clones the file when the filesystem supports copy-on-write (btrfs, xfs...) so no data is moved, and
+    finally falls back to shutil.copyfile which copies in the kernel via sendfile. The file is always written under a
+    private name and then renamed over the target, an existing target might be a link to the user's repositories so
+    it's never opened for writing"""
+    staging = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.unlink(staging)
+    except FileNotFoundError:
+        pass
+    try:
+        try:
+            os.link(source, staging)
+        except OSError:
+            ficlone = getattr(fcntl, "FICLONE", None)
+            cloned = False
+            if ficlone is not None:
+                with open(source, "rb") as src, open(staging, "xb") as dst:
+                    try:
+                        fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+                        cloned = True
+                    except OSError:
+                        pass
+            if not cloned:
+                shutil.copyfile(source, staging)
+            # keep the modification time so the workspace index recognizes unchanged dependencies
+            stat = os.stat(source)
+            os.utime(staging, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(staging, target)
+    except BaseException:
+        try:
+            os.unlink(staging)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def _copy_maven_central_dependency(dep: Dependency, target: str) -> bool:
-    local_file = os.path.join(target, f"{dep.artifact_id}-{dep.version}.{dep.type}")
-    group = dep.group_id.replace(".", "/")
-    url = f"https://repo1.maven.org/maven2/{group}/{dep.artifact_id}/{dep.version}/{dep.artifact_id}-{dep.version}.{dep.type}"
+    """Downloads the dependency from Maven Central, released artifacts never change so they are kept in the cache and
+    only downloaded once"""
+    local_file = os.path.join(target, dep.workspace_name)
+    cached_file = os.path.join(CACHE_DIR, "central", dep.group_path, dep.artifact_id, dep.version, dep.file_name)
+    try:
+        _fast_copy(cached_file, local_file)
+        return True
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logging.exception(f"Failed to copy cached dependency from '{cached_file}'")
+
+    # the download goes to a private file which is then renamed into place, so a path that might be linked to the
+    # workspace or to the cache is never written through. The cache might not be writable, e.g. when it's mounted
+    # from a host folder owned by another user, the file is then downloaded straight into the workspace
+    try:
+        os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+        handle, download = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cached_file))
+        destination = cached_file
+    except OSError:
+        logging.exception(f"Failed to cache dependency in '{cached_file}'")
+        handle, download = tempfile.mkstemp(suffix=".tmp", dir=target)
+        destination = local_file
+    os.close(handle)
+    try:
+        path = f"/maven2/{dep.group_path}/{dep.artifact_id}/{dep.version}/{dep.file_name}"
+        if not _download_maven_central_file(path, download):
+            return False
+        os.replace(download, destination)
+    finally:
+        try:
+            os.unlink(download)
+        except FileNotFoundError:
+            pass
+
+    if destination == cached_file:
+        _fast_copy(cached_file, local_file)
+    return True
+
+
+def _download_maven_central_file(path: str, local_file: str) -> bool:
+    url = f"https://{MAVEN_CENTRAL_HOST}{path}"
+    for attempt in range(MAX_DOWNLOAD_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(DOWNLOAD_BACKOFF * 2 ** (attempt - 1))
+        connection = _maven_central_connection()
+        try:
+            connection.request("GET", path)
+            with connection.getresponse() as remote:
+                if remote.status == 200:
+                    with open(local_file, "wb") as local:
+                        shutil.copyfileobj(remote, local, length=1 << 20)
+                    return True
+                remote.read()  # drain the body so the connection can be reused
+                if 300 <= remote.status < 400:
+                    location = remote.getheader("Location")
+                    if location is None:
+                        logging.error(f"Failed to download dependency from {url}, redirected without a location")
+                        return False
+                    location = urllib.parse.urljoin(url, location)
+                    logging.warning(f"Download of {url} redirected to {location}")
+                    return _download_redirected_file(location, local_file)
+                if remote.status != 429 and remote.status < 500:
+                    return False
+                if attempt == MAX_DOWNLOAD_RETRIES:
+                    logging.error(f"Failed to download dependency from {url}, status {remote.status}")
+        except (OSError, http.client.HTTPException):
+            # the server might have closed the kept-alive connection, retry with a fresh one
+            _close_maven_central_connection()
+            try:
+                os.unlink(local_file)  # do not leave a truncated artifact behind
+            except FileNotFoundError:
+                pass
+            if attempt == MAX_DOWNLOAD_RETRIES:
+                logging.exception(f"Failed to download dependency from {url}")
+    return False
+
+
+def _download_redirected_file(url: str, local_file: str) -> bool:
+    """Downloads a file Maven Central redirected to, urllib follows any further redirect and goes through the
+    configured proxies"""
     try:
         with urllib.request.urlopen(url) as remote, open(local_file, "wb") as local:
-            if remote.code != 200:
-                return False
-            local.write(remote.read())
-            return True
-    except URLError:
-        logging.exception(f"Failed to download dependency from {url}")
+            shutil.copyfileobj(remote, local, length=1 << 20)
+        return True
+    except urllib.error.HTTPError as e:
+        if e.code == 429 or e.code >= 500:
+            raise  # retried by the caller
+        logging.error(f"Failed to download dependency from {url}, status {e.code}")
         return False
 
 
+def _maven_central_connection() -> http.client.HTTPSConnection:
+    """Returns the connection to Maven Central owned by the current thread, it's kept alive between downloads to
+    avoid paying the TCP and TLS handshakes for each dependency. Like urllib, it goes through the proxy configured in
+    https_proxy unless the host is listed in no_proxy"""
+    connection = getattr(_connections, "maven_central", None)
+    if connection is None:
+        proxy = urllib.request.getproxies().get("https")
+        if proxy is not None and not urllib.request.proxy_bypass(MAVEN_CENTRAL_HOST):
+            proxy_url = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+            headers = dict()
+            if proxy_url.username is not None:
+                user = urllib.parse.unquote(proxy_url.username)
+                credentials = f"{user}:{urllib.parse.unquote(proxy_url.password or '')}"
+                headers["Proxy-Authorization"] = f"Basic {base64.b64encode(credentials.encode()).decode()}"
+            connection = http.client.HTTPSConnection(proxy_url.hostname, proxy_url.port)
+            connection.set_tunnel(MAVEN_CENTRAL_HOST, headers=headers)
+        else:
+            connection = http.client.HTTPSConnection(MAVEN_CENTRAL_HOST)
+        _connections.maven_central = connection
+    return connection
+
+
+def _close_maven_central_connection():
+    connection = getattr(_connections, "maven_central", None)
+    if connection is not None:
+        connection.close()
+        _connections.maven_central = None
+
+
 def _extract_maven_dependencies(args: Namespace) -> set[Dependency]:
     """Extracts the different Maven coordinates from a dependency tree in JSON format"""
     input_file = args.input
@@ -267,7 +667,7 @@ def _extract_maven_dependencies(args: Namespace) -> set[Dependency]:
         sys.exit(1)
 
     dependencies = set()
-    json_deps = list()
+    json_deps = deque()
     with open(input_file) as target:
         try:
             parsed = json.load(target)
@@ -281,16 +681,17 @@ def _extract_maven_dependencies(args: Namespace) -> set[Dependency]:
             json_deps.append(parsed)
 
     while len(json_deps) > 0:
-        dep = json_deps.pop(0)
-        dependencies.add(
-            Dependency(
-                dep["groupId"],
-                dep["artifactId"],
-                dep["version"],
-                dep["scope"],
-                dep["type"],
-            )
+        dep = json_deps.popleft()
+        dependency = Dependency(
+            dep["groupId"],
+            dep["artifactId"],
+            dep["version"],
+            dep["scope"],
+            dep["type"],
         )
+        if dependency in dependencies:
+            continue  # its subtree has already been visited
+        dependencies.add(dependency)
         if "children" in dep:
             json_deps.extend(dep["children"])
 
@@ -305,23 +706,14 @@ def _extract_gradle_dependencies(args: Namespace) -> set[Dependency]:
         sys.exit(1)
 
     dependencies = set()
-    with open(input_file) as target:
-        for line in target:
-            match = re.search(r"[+\\]--- (\S+:\S+:.+$)", line)
-            if match is not None:
-                coordinates = match.group(1)
-                try:
-                    parts = coordinates.split(":")
-                    group = parts[0].strip()
-                    artifact = parts[1].strip()
-                    version = parts[2].strip()
-                    upgraded_version_idx = version.find(' -> ')
-                    if upgraded_version_idx >= 0:
-                        version = version[upgraded_version_idx + 4:].strip()
-                    version = re.sub(r"\s*(?:\(.+\))?\s*", "", version)  # remove (*)
-                    dependencies.add(Dependency(group, artifact, version))
-                except Exception:
-                    logging.exception(f"Failed to extract maven coordinates from '{coordinates}'")
+    with open(input_file, "rb") as target:
+        if os.fstat(target.fileno()).st_size == 0:
+            return dependencies
+        # the whole report is scanned in place, only the coordinates are decoded
+        with mmap.mmap(target.fileno(), 0, access=mmap.ACCESS_READ) as report:
+            for match in _GRADLE_DEPENDENCY.finditer(report):
+                group, artifact, version = (value.decode() for value in match.group("group", "artifact", "version"))
+                dependencies.add(Dependency(group, artifact, version))
 
     return dependencies
 
@@ -342,6 +734,11 @@ def _analyze_gradle(args: Namespace):
 
 def analyze():
     """Parses the arguments provided via the CLI and calls the concrete analyze method."""
+    logging.basicConfig(filename=LOG_FILE,
+                        filemode='w',
+                        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.DEBUG)
     parser = argparse.ArgumentParser(prog="run.sh")
     parser.add_argument(
         "--type",
@@ -383,4 +780,5 @@ def analyze():
             sys.exit(1)
 
 
-analyze()
+if __name__ == "__main__":
+    analyze()